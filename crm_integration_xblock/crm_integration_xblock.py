@@ -4,14 +4,19 @@ CRM Integration Xblock.
 This module is the actual implementation of the Xblock related classes
 """
 
+import copy
+import functools
+import hashlib
+import importlib.resources
 import json
+import threading
+import time
+import types
 
-from collections import OrderedDict
-from urllib.parse import urlencode
+from urllib.parse import quote_plus
 from opaque_keys.edx.keys import CourseKey
 
 import requests
-import pkg_resources
 
 from xblock.core import XBlock
 from xblock.fields import Scope, String
@@ -19,12 +24,188 @@ from xblock.fragment import Fragment
 from xblockutils.studio_editable import StudioEditableXBlockMixin
 
 from .varkey_validations import SalesForceVarkey
-from .salesforce_tasks import SalesForce
+from .salesforce_tasks import SESSION, TIMEOUT, TOKEN_SESSION, SalesForce, SalesForceUnauthorized
 from .tracking import emit
 
 
-BACKENDS = {"generic": SalesForce,
-            "varkey": SalesForceVarkey}
+BACKENDS = types.MappingProxyType({"generic": SalesForce,
+                                   "varkey": SalesForceVarkey})
+
+# Body of the token request, the keys are already url encoded
+TOKEN_PAYLOAD = "grant_type=password&client_id={client_id}&client_secret={client_secret}" \
+                "&username={username}&password={password}"
+TOKEN_HEADERS = {'content-type': "application/x-www-form-urlencoded",
+                 'connection': "keep-alive", }
+
+# SalesForce access tokens shared by every block of this process, indexed by
+# (url, client_id, username, digest of the secrets) and holding
+# (access_token, instance_url, expires_at).
+_TOKEN_CACHE = {}
+_TOKEN_CACHE_LOCK = threading.Lock()
+# SalesForce does not always report the token lifetime, assume a short session
+TOKEN_DEFAULT_LIFETIME = 1800
+# Seconds before the expiration time in which a cached token is not used anymore
+TOKEN_EXPIRATION_MARGIN = 60
+
+
+@functools.lru_cache(maxsize=32)
+def _resource_string(path):
+    """Read and decode a resource of the package. The static files don't change at run time."""
+    return (importlib.resources.files(__package__) / path).read_text("utf8")
+
+
+STUDENT_HTML = "static/html/crm-integration-student.html"
+AUTHOR_HTML = "static/html/crm-integration-author.html"
+CSS = "static/css/crm-integration-xblock.css"
+JS = "static/js/src/crm-integration-xblock.js"
+
+
+def _split_template(template, placeholder):
+    """
+    Split a str.format template around its placeholder, so it can be rendered
+    with placeholder_value.join(parts). Escaped braces are resolved here.
+    """
+    return tuple(part.replace("{{", "{").replace("}}", "}") for part in template.split(placeholder))
+
+
+# Load and prepare the static files at import time, so the views don't have to
+STUDENT_PARTS = _split_template(_resource_string(STUDENT_HTML), "{lms_handler_url}")
+AUTHOR_PARTS = _split_template(_resource_string(AUTHOR_HTML), "{lms_handler_url}")
+CSS_CONTENT = _resource_string(CSS)
+JS_CONTENT = _resource_string(JS)
+
+
+# Compatibility anonymous ids found so far, indexed by (anonymous_student_id, course_id).
+# They never change once assigned, so they are not invalidated.
+_COMPAT_ANONYMOUS_IDS = {}
+_COMPAT_ANONYMOUS_IDS_LOCK = threading.Lock()
+COMPAT_ANONYMOUS_IDS_MAXSIZE = 4096
+
+
+@functools.lru_cache(maxsize=256)
+def _compat_course_key(course_id_str):
+    """Create a compatibility course id with suffix _CRM_XBLOCK"""
+    return CourseKey.from_string('{}_CRM_XBLOCK'.format(course_id_str))
+
+
+# Results of the last successful writes, to answer the duplicated ones a browser may send.
+# Reads are never cached, a write served by another worker or block would make them stale.
+# Indexed by (anonymous_student_id, usage_id), each entry maps a payload fingerprint
+# to (expires_at, result).
+_RESULT_CACHE = {}
+_RESULT_CACHE_LOCK = threading.Lock()
+RESULT_CACHE_TTL = 30
+RESULT_CACHE_MAXSIZE = 10000
+# Values of the method of a submission that change records in SalesForce, only those are cached
+WRITE_METHODS = ("send", "POST", "PATCH")
+
+
+def _fingerprint(data):
+    """Hash of a submission payload, independent of the order of its keys"""
+    if not isinstance(data, str):
+        data = json.dumps(data, sort_keys=True)
+    return hashlib.blake2b(data.encode("utf8"), digest_size=16).hexdigest()
+
+
+def _get_cached_result(key, fingerprint):
+    """Return the result of an identical submission made less than RESULT_CACHE_TTL seconds ago"""
+    with _RESULT_CACHE_LOCK:
+        entry = _RESULT_CACHE.get(key, {}).get(fingerprint)
+    if entry and entry[0] > time.time():
+        return entry[1]
+    return None
+
+
+def _cache_result(key, fingerprint, result):
+    """Remember the result of a successful write"""
+    now = time.time()
+    with _RESULT_CACHE_LOCK:
+        if len(_RESULT_CACHE) >= RESULT_CACHE_MAXSIZE:
+            _RESULT_CACHE.clear()
+        results = {fp: entry for fp, entry in _RESULT_CACHE.get(key, {}).items() if entry[0] > now}
+        results[fingerprint] = (now + RESULT_CACHE_TTL, result)
+        _RESULT_CACHE[key] = results
+
+
+def _is_successful(result):
+    """Whether a backend result explicitly reports a success, only those are cached"""
+    if not isinstance(result, dict):
+        return False
+    if "success" in result:
+        return result["success"] is True
+    status_code = result.get("status_code")
+    return isinstance(status_code, int) and 200 <= status_code < 300
+
+
+def _invalidate_results(key):
+    """Forget the writes of a user in a block, after records were deleted"""
+    with _RESULT_CACHE_LOCK:
+        _RESULT_CACHE.pop(key, None)
+
+
+# Backend instances reused across requests, indexed by (backend_name, instance_url).
+# The pool is per thread, as the instances are rebound to the context of each request.
+_BACKEND_POOL = threading.local()
+
+
+def _get_backend(backend_name, instance_url, access_token, username, method, initial):  # pylint: disable=too-many-arguments
+    """Return a pooled backend instance bound to the given context"""
+    pool = getattr(_BACKEND_POOL, "backends", None)
+    if pool is None:
+        pool = _BACKEND_POOL.backends = {}
+    key = (backend_name, instance_url)
+    backend = pool.get(key)
+    if backend is None:
+        backend = pool[key] = BACKENDS[backend_name](
+            access_token,
+            instance_url,
+            username,
+            method,
+            initial,
+            session=SESSION
+        )
+    else:
+        backend.update_context(access_token, username, method, initial)
+    return backend
+
+
+def _token_cache_key(url, client_id, username, client_secret, password, security_token):  # pylint: disable=too-many-arguments
+    """
+    Index of a token in the cache. It includes a digest of the secrets, so only a block
+    configured with the same credentials can use a token.
+    """
+    secrets = "\0".join(str(secret) for secret in (client_secret, password, security_token))
+    digest = hashlib.blake2b(secrets.encode("utf8"), digest_size=16).hexdigest()
+    return (url, client_id, username, digest)
+
+
+def _get_cached_token(key):
+    """Return the cached (access_token, instance_url, expires_at) for key if it is still valid"""
+    with _TOKEN_CACHE_LOCK:
+        entry = _TOKEN_CACHE.get(key)
+    if entry and entry[2] - TOKEN_EXPIRATION_MARGIN > time.time():
+        return entry
+    return None
+
+
+def _cache_token(key, response_salesforce):
+    """Store the token returned by SalesForce and return the cache entry"""
+    issued_at = response_salesforce.get("issued_at")
+    # issued_at is sent by SalesForce as a string of milliseconds since epoch
+    issued_at = int(issued_at) / 1000.0 if issued_at else time.time()
+    expires_in = int(response_salesforce.get("expires_in", TOKEN_DEFAULT_LIFETIME))
+    entry = (response_salesforce["access_token"],
+             response_salesforce["instance_url"],
+             issued_at + expires_in)
+    with _TOKEN_CACHE_LOCK:
+        _TOKEN_CACHE[key] = entry
+    return entry
+
+
+def _evict_token(key):
+    """Remove a token SalesForce does not accept anymore"""
+    with _TOKEN_CACHE_LOCK:
+        _TOKEN_CACHE.pop(key, None)
 
 
 class CrmIntegration(StudioEditableXBlockMixin, XBlock):
@@ -84,10 +265,14 @@ class CrmIntegration(StudioEditableXBlockMixin, XBlock):
                        'password',
                        'security_token',)
 
+    @functools.cached_property
+    def _is_studio(self):
+        """Whether the block is rendered by the Studio runtime. XBlock instances live for one request."""
+        return hasattr(self.xmodule_runtime, 'is_author_mode')  # pylint: disable=no-member
+
     def resource_string(self, path):
         """Handy helper for getting resources from our kit."""
-        data = pkg_resources.resource_string(__name__, path)
-        return data.decode("utf8")
+        return _resource_string(path)
 
     def student_view(self, context=None):
         """
@@ -97,15 +282,12 @@ class CrmIntegration(StudioEditableXBlockMixin, XBlock):
         # pylint: disable=no-member
         context = self.get_general_rendering_context(context)
 
-        in_studio_runtime = hasattr(self.xmodule_runtime, 'is_author_mode')
-
-        if in_studio_runtime:
+        if self._is_studio:
             return self.author_view(context)
 
-        html = self.resource_string("static/html/crm-integration-student.html")
-        frag = Fragment(html.format(**context))
-        frag.add_css(self.resource_string("static/css/crm-integration-xblock.css"))
-        frag.add_javascript(self.resource_string("static/js/src/crm-integration-xblock.js"))
+        frag = Fragment(context["lms_handler_url"].join(STUDENT_PARTS))
+        frag.add_css(CSS_CONTENT)
+        frag.add_javascript(JS_CONTENT)
         frag.initialize_js('CrmIntegrationLms')
         return frag
 
@@ -115,10 +297,9 @@ class CrmIntegration(StudioEditableXBlockMixin, XBlock):
         Should display an example on how to use this xblock.
         """
         # pylint: disable=unused-argument, no-self-use
-        html = self.resource_string("static/html/crm-integration-author.html")
-        frag = Fragment(html.format(**context))
-        frag.add_css(self.resource_string("static/css/crm-integration-xblock.css"))
-        frag.add_javascript(self.resource_string("static/js/src/crm-integration-xblock.js"))
+        frag = Fragment(context["lms_handler_url"].join(AUTHOR_PARTS))
+        frag.add_css(CSS_CONTENT)
+        frag.add_javascript(JS_CONTENT)
         frag.initialize_js('CrmIntegrationStudio')
 
         return frag
@@ -128,27 +309,32 @@ class CrmIntegration(StudioEditableXBlockMixin, XBlock):
         This method generate an authentication token for SalesForce
         """
         # pylint: disable=unused-argument
-        payload = urlencode(OrderedDict(grant_type="password", client_id=client_id,
-                                        client_secret=client_secret,
-                                        username=username,
-                                        password="{}{}".format(password, security_token)))
+        payload = TOKEN_PAYLOAD.format(client_id=quote_plus(client_id or ""),
+                                       client_secret=quote_plus(client_secret or ""),
+                                       username=quote_plus(username or ""),
+                                       password=quote_plus("{}{}".format(password, security_token)))
 
-        headers = {'content-type': "application/x-www-form-urlencoded", }
-        response = requests.request("POST", url, data=payload, headers=headers)
+        response = TOKEN_SESSION.post(url, data=payload, headers=TOKEN_HEADERS, timeout=TIMEOUT)
 
+        retries = getattr(response.raw, "retries", None)
+        tracking_data = {"retries": len(retries.history) if retries else 0}
         if response.status_code == 200:
-            emit("crm_integration_xblock.generate_token.success", 10)
+            emit("crm_integration_xblock.generate_token.success", 10, data=tracking_data)
         else:
-            emit("crm_integration_xblock.generate_token.error", 30)
+            emit("crm_integration_xblock.generate_token.error", 30, data=tracking_data)
         return response
 
     def _init_fs_class(self, data):
         """
         This method receive data to process CRM request
         """
-        is_studio = hasattr(self.xmodule_runtime, 'is_author_mode')  # pylint: disable=no-member
+        if isinstance(data, str):
+            data = json.loads(data)
         data_no_init = data.get("no_init", False)
-        if is_studio or data_no_init:
+        method = data.get("method", None)
+        initial = data.get("initial", None)
+
+        if self._is_studio or data_no_init:
             emit("crm_integration_xblock.initialization.no_init", 10)
             return {
                 "status_code": 204,
@@ -156,40 +342,91 @@ class CrmIntegration(StudioEditableXBlockMixin, XBlock):
                 "success": False
             }
 
-        backend_name = self.backend_name
-        url = self.url
-        client_id = self.client_id
-        client_secret = self.client_secret
-        username = self.username
-        password = self.password
-        security_token = self.security_token
+        # No field is read before this point, Studio and no_init calls don't need them
+        backend_name, url, client_id, client_secret, username, password, security_token = (
+            self.backend_name, self.url, self.client_id, self.client_secret,
+            self.username, self.password, self.security_token
+        )
 
-        token = self.generate_token(url, client_id, client_secret, username, password, security_token)
+        token_key = _token_cache_key(url, client_id, username, client_secret, password, security_token)
+        cached_token = _get_cached_token(token_key)
+
+        if cached_token is None:
+            try:
+                token = self.generate_token(url, client_id, client_secret, username, password, security_token)
+            except requests.RequestException:
+                emit("crm_integration_xblock.initialization.{}.token_request_failed".format(backend_name), 30)
+                return {"status_code": 503,
+                        "message": "Token not generated",
+                        "success": False}
+
+            if token.status_code != 200:
+                emit("crm_integration_xblock.initialization.{}.no_token_generated".format(backend_name), 10)
+                return {"status_code": token.status_code,
+                        "message": "Token not generated",
+                        "success": False}
+
+            try:
+                cached_token = _cache_token(token_key, token.json())
+            except ValueError:
+                emit("crm_integration_xblock.initialization.{}.invalid_token_response".format(backend_name), 30)
+                return {"status_code": 502,
+                        "message": "Token not generated",
+                        "success": False}
+            from_cache = False
+        else:
+            emit("crm_integration_xblock.initialization.{}.cached_token".format(backend_name), 10)
+            from_cache = True
+
+        access_token, instance_url, _ = cached_token
+        username = self.get_anonymous_id_comp_crm()
+        # pylint: disable=attribute-defined-outside-init
+        self.fs_class = _get_backend(backend_name, instance_url, access_token, username, method, initial)
+        emit("crm_integration_xblock.initialization.{}.success".format(backend_name), 10)
+        return {"status_code": 200,
+                "token_key": token_key,
+                "from_cache": from_cache}
+
+    def _run_backend(self, data, action):
+        """
+        Initialize the backend and run one of its methods with the data.
+        If SalesForce rejects a cached token, it is discarded and the call is retried once
+        with a new token.
+        """
+        crm_data = self._init_fs_class(data)
+        if crm_data["status_code"] != 200:
+            return crm_data
 
-        if token.status_code != 200:
-            emit("crm_integration_xblock.initialization.{}.no_token_generated".format(backend_name), 10)
-            return {"status_code": token.status_code,
-                    "message": "Token not generated",
+        try:
+            try:
+                # The backends modify the data they receive, keep the original for the retry
+                return getattr(self.fs_class, action)(copy.deepcopy(data) if crm_data["from_cache"] else data)
+            except SalesForceUnauthorized:
+                if not crm_data["from_cache"]:
+                    raise
+
+            emit("crm_integration_xblock.initialization.expired_token", 20)
+            _evict_token(crm_data["token_key"])
+            crm_data = self._init_fs_class(data)
+            if crm_data["status_code"] != 200:
+                return crm_data
+            return getattr(self.fs_class, action)(data)
+        except SalesForceUnauthorized:
+            emit("crm_integration_xblock.{}.unauthorized".format(action), 30)
+            return {"status_code": 401,
+                    "message": "SalesForce rejected the token",
+                    "success": False}
+        except ValueError:
+            # Also requests' JSONDecodeError, which is a RequestException too
+            emit("crm_integration_xblock.{}.invalid_response".format(action), 30)
+            return {"status_code": 502,
+                    "message": "SalesForce sent an invalid response",
+                    "success": False}
+        except requests.RequestException:
+            emit("crm_integration_xblock.{}.request_failed".format(action), 30)
+            return {"status_code": 503,
+                    "message": "SalesForce did not respond",
                     "success": False}
-        else:
-            response_salesforce = json.loads(token.text)
-            access_token = response_salesforce["access_token"]
-            instance_url = response_salesforce["instance_url"]
-            username = self.get_anonymous_id_comp_crm()
-            if isinstance(data, str):
-                data = json.loads(data)
-            method = data.get("method", None)
-            initial = data.get("initial", None)
-            # pylint: disable=attribute-defined-outside-init
-            self.fs_class = BACKENDS[backend_name](
-                access_token,
-                instance_url,
-                username,
-                method,
-                initial
-            )
-            emit("crm_integration_xblock.initialization.{}.success".format(backend_name), 10)
-            return {"status_code": token.status_code}
 
     @XBlock.json_handler
     def send_crm_data(self, data, suffix=''):
@@ -197,12 +434,23 @@ class CrmIntegration(StudioEditableXBlockMixin, XBlock):
         This method sends the data to the appropriate backend which in turn sends it to the CRM
         """
         # pylint: disable=unused-argument
-        crm_data = self._init_fs_class(data)
-
-        if crm_data["status_code"] == 200:
-            return self.fs_class.validate(data)
-        else:
-            return crm_data
+        if isinstance(data, str):
+            data = json.loads(data)
+        if data.get("method") not in WRITE_METHODS:
+            return self._run_backend(data, "validate")
+
+        key = self._result_cache_key()
+        # The backends modify the data, take the fingerprint before
+        fingerprint = _fingerprint(data)
+        result = _get_cached_result(key, fingerprint)
+        if result is not None:
+            emit("crm_integration_xblock.send_crm_data.duplicated", 10)
+            return result
+
+        result = self._run_backend(data, "validate")
+        if _is_successful(result):
+            _cache_result(key, fingerprint, result)
+        return result
 
     @XBlock.json_handler
     def delete_crm_data(self, data, suffix=''):
@@ -210,11 +458,13 @@ class CrmIntegration(StudioEditableXBlockMixin, XBlock):
         This method DELETE the data to the appropriate backend which in turn sends it to the CRM
         """
         # pylint: disable=unused-argument
-        crm_data = self._init_fs_class(data)
-        if crm_data["status_code"] == 200:
-            return self.fs_class._delete_data(data)  # pylint: disable=protected-access
-        else:
-            return crm_data
+        # Deleting is not cached, and a previous write may have to be sent again afterwards
+        _invalidate_results(self._result_cache_key())
+        return self._run_backend(data, "_delete_data")
+
+    def _result_cache_key(self):
+        """Index of the cached submissions of the current user in this block"""
+        return (self.runtime.anonymous_student_id, str(self.scope_ids.usage_id))
 
     def get_general_rendering_context(self, context=None):
         """
@@ -224,16 +474,20 @@ class CrmIntegration(StudioEditableXBlockMixin, XBlock):
             context = {}
 
         context["self"] = self
+        context["lms_handler_url"] = self._lms_handler_url
 
+        return context
+
+    @functools.cached_property
+    def _lms_handler_url(self):
+        """The handler url only depends on the course and the block, build it once per instance"""
         # Adapted from lms/urls.py # xblock Handler APIs
-        context["lms_handler_url"] = '/courses/{course_key}/xblock/{usage_key}/handler/{handler_name}'.format(
+        return '/courses/{course_key}/xblock/{usage_key}/handler/{handler_name}'.format(
             course_key=self.course_id,  # pylint: disable=no-member
             usage_key=self.url_name,  # pylint: disable=no-member
             handler_name='send_crm_data',  # manually set
         )
 
-        return context
-
     def get_anonymous_id_comp_crm(self):
         """
         Helper method to obtain the correct compatibility anonymous_id.
@@ -241,17 +495,26 @@ class CrmIntegration(StudioEditableXBlockMixin, XBlock):
         otherwise returns the current anonymous_id
         """
         current_anonymous_student_id = self.runtime.anonymous_student_id
-        user = self.runtime.get_real_user(current_anonymous_student_id)
         course_id_str = str(self.runtime.course_id)
-        # Create a compatibility course id with suffix _CRM_XBLOCK
-        compat_course_id = CourseKey.from_string('{}_CRM_XBLOCK'.format(course_id_str))
-        try:
-            # Check if the user has a previous assigned anonymous_id
-            compat_anonymous_student_id = user.anonymoususerid_set.get(course_id=compat_course_id)
-        except user.anonymoususerid_set.model.DoesNotExist:
+        key = (current_anonymous_student_id, course_id_str)
+        compat_anonymous_student_id = _COMPAT_ANONYMOUS_IDS.get(key)
+        if compat_anonymous_student_id:
+            return compat_anonymous_student_id
+
+        user = self.runtime.get_real_user(current_anonymous_student_id)
+        # Check if the user has a previous assigned anonymous_id
+        compat_anonymous_student_id = user.anonymoususerid_set.filter(
+            course_id=_compat_course_key(course_id_str)
+        ).values_list('anonymous_user_id', flat=True).first()
+        if not compat_anonymous_student_id:
+            # Not cached, the compatibility id could still be assigned later
             return current_anonymous_student_id
-        else:
-            return compat_anonymous_student_id.anonymous_user_id
+
+        with _COMPAT_ANONYMOUS_IDS_LOCK:
+            if len(_COMPAT_ANONYMOUS_IDS) >= COMPAT_ANONYMOUS_IDS_MAXSIZE:
+                _COMPAT_ANONYMOUS_IDS.clear()
+            _COMPAT_ANONYMOUS_IDS[key] = compat_anonymous_student_id
+        return compat_anonymous_student_id
 
     @staticmethod
     def workbench_scenarios():
@@ -4,21 +4,89 @@ This class only will work for Varkey requirements.
 
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from .tracking import emit, serialize_response
 
 
 VERSION = "v41.0"
 
+# Maximum number of subrequests SalesForce accepts in a Composite Batch request
+BATCH_LIMIT = 25
+
+# (connect, read) timeouts in seconds for the requests made to SalesForce
+TIMEOUT = (3.05, 10)
+
+
+def build_session(max_retries):
+    """
+    Create a session that keeps the HTTPS connections to SalesForce alive between requests.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4,
+                          pool_maxsize=32,
+                          max_retries=max_retries)
+    session.mount("https://", adapter)
+    return session
+
+
+# Shared by the backends of this process. Only idempotent requests are retried,
+# retrying a POST could create the records twice.
+SESSION = build_session(Retry(total=2,
+                              backoff_factor=0.2,
+                              status_forcelist=[502, 503, 504],
+                              raise_on_status=False))
+
+# Used for the token requests, which can be repeated safely. A single retry, and none after
+# a read timeout, keeps a token request within two TIMEOUTs. Retry-After is not honoured,
+# as SalesForce could ask for an unbounded wait.
+TOKEN_SESSION = build_session(Retry(total=1,
+                                    connect=1,
+                                    read=0,
+                                    status_forcelist=[429, 500, 502, 503, 504],
+                                    allowed_methods=["POST"],
+                                    backoff_factor=0.3,
+                                    respect_retry_after_header=False,
+                                    raise_on_status=False))
+
+
+class SalesForceUnauthorized(Exception):
+    """
+    SalesForce rejected the access token of a request, the caller can renew it.
+    """
+
+
 class SalesForce(object):
     """
     Class for handles main requests methods of SalesForce.
     """
 
-    def __init__(self, token, instance_url):
+    def __init__(self, token, instance_url, session=None):
         self.headers = {"authorization": "Bearer {}".format(token), "content-type": "application/json",}
         self.base_url = "{}/services/data/{}/sobjects/".format(instance_url, VERSION)
         self.query_url = "{}/services/data/{}/query/".format(instance_url, VERSION)
         self.bulk_url = "{}/services/data/{}/composite/tree/".format(instance_url, VERSION)
+        self.batch_url = "{}/services/data/{}/composite/batch/".format(instance_url, VERSION)
+        self.session = session or SESSION
+
+    def update_context(self, token, *args):  # pylint: disable=unused-argument
+        """
+        Rebind an existing instance to a new access token, so it can be reused
+        across requests to the same SalesForce instance.
+        """
+        self.headers = {"authorization": "Bearer {}".format(token), "content-type": "application/json",}
+
+    def _request(self, method, url, **kwargs):
+        """
+        Make a request to SalesForce with the authentication headers.
+        Every request is time limited, so a slow SalesForce can not hold the worker indefinitely.
+        Raises SalesForceUnauthorized if the token is rejected, before the caller parses the response.
+        """
+        kwargs.setdefault("timeout", TIMEOUT)
+        response = self.session.request(method, url, headers=self.headers, **kwargs)
+        if response.status_code == 401:
+            raise SalesForceUnauthorized(response.text)
+        return response
 
     def validate(self, data):
         """
@@ -32,8 +100,8 @@ class SalesForce(object):
         """
         url = self.query_url
         params = {"q":query}
-        response = requests.request("GET", url, headers=self.headers, params=params)
-        emit("crm_integration_xblock.SalesForce.query", 10, data={
+        response = self._request("GET", url, params=params)
+        emit("crm_integration_xblock.SalesForce.query", 10, data=lambda: {
             "url": url,
             "params": params,
             "response": serialize_response(response),
@@ -49,8 +117,8 @@ class SalesForce(object):
             url = "{}{}/{}".format(self.base_url, salesforce_object, id_object)
         else:
             url = "{}{}".format(self.base_url, salesforce_object)
-        response = requests.request("GET", url, data=json.dumps(data), headers=self.headers)
-        emit("crm_integration_xblock.SalesForce.get", 10, data={
+        response = self._request("GET", url, data=json.dumps(data))
+        emit("crm_integration_xblock.SalesForce.get", 10, data=lambda: {
             "url": url,
             "data": data,
             "response": serialize_response(response),
@@ -62,9 +130,9 @@ class SalesForce(object):
         Make POST request.
         """
         url = "{}{}".format(self.base_url, salesforce_object)
-        sf_response = requests.request("POST", url, data=json.dumps(data), headers=self.headers)
+        sf_response = self._request("POST", url, data=json.dumps(data))
 
-        emit("crm_integration_xblock.SalesForce.create", 10, data={
+        emit("crm_integration_xblock.SalesForce.create", 10, data=lambda: {
             "url": url,
             "data": data,
             "response": serialize_response(sf_response),
@@ -80,9 +148,9 @@ class SalesForce(object):
         Make PATCH request to SalesForce, id_object it's mandatory.
         """
         url = "{}{}/{}".format(self.base_url, salesforce_object, id_object)
-        sf_response = requests.request("PATCH", url, data=json.dumps(data), headers=self.headers)
+        sf_response = self._request("PATCH", url, data=json.dumps(data))
 
-        emit("crm_integration_xblock.SalesForce.create", 10, data={
+        emit("crm_integration_xblock.SalesForce.create", 10, data=lambda: {
             "url": url,
             "data": data,
             "response": serialize_response(sf_response),
@@ -101,8 +169,8 @@ class SalesForce(object):
                                            object=salesforce_object,
                                            id=id_object)
 
-        response = requests.request("DELETE", url, headers=self.headers)
-        emit("crm_integration_xblock.SalesForce.create", 10, data={
+        response = self._request("DELETE", url)
+        emit("crm_integration_xblock.SalesForce.create", 10, data=lambda: {
             "url": url,
             "response": serialize_response(response),
         })
@@ -116,11 +184,69 @@ class SalesForce(object):
         Create or update multiple records in one request.
         """
         url = "{}{}".format(self.bulk_url, salesforce_object)
-        response = requests.request("POST", url, data=json.dumps(data), headers=self.headers)
-        emit("crm_integration_xblock.SalesForce.create", 10, data={
+        response = self._request("POST", url, data=json.dumps(data))
+        emit("crm_integration_xblock.SalesForce.create", 10, data=lambda: {
             "url": url,
             "data": data,
             "response": serialize_response(response),
         })
         return response
 
+    def batch(self, subrequests):
+        """
+        Execute multiple subrequests with the Composite Batch resource. Lists longer than
+        BATCH_LIMIT are split in several calls. Returns the result of each subrequest, in order.
+        """
+        results = []
+        for start in range(0, len(subrequests), BATCH_LIMIT):
+            batch_requests = subrequests[start:start + BATCH_LIMIT]
+            data = {"batchRequests": batch_requests}
+            response = self._request("POST", self.batch_url, data=json.dumps(data))
+            emit("crm_integration_xblock.SalesForce.batch", 10, data=lambda data=data, response=response: {
+                "url": self.batch_url,
+                "data": data,
+                "response": serialize_response(response),
+            })
+            if response.status_code != 200:
+                results.extend({"statusCode": response.status_code, "result": response.text}
+                               for _ in batch_requests)
+            else:
+                results.extend(response.json()["results"])
+        return results
+
+    def update_many(self, salesforce_object, records):
+        """
+        PATCH several records in as few requests as possible. records is a list of
+        (id_object, data) tuples. Returns the same results as update, in order.
+        """
+        return [self._batch_result(result, 204) for result in self.batch([
+            {"method": "PATCH",
+             "url": "{}/sobjects/{}/{}".format(VERSION, salesforce_object, id_object),
+             "richInput": data}
+            for id_object, data in records
+        ])]
+
+    def delete_many(self, salesforce_object, ids_object):
+        """
+        Delete several records in as few requests as possible.
+        Returns the same results as delete, in order.
+        """
+        return [self._batch_result(result, 204) for result in self.batch([
+            {"method": "DELETE",
+             "url": "{}/sobjects/{}/{}".format(VERSION, salesforce_object, id_object)}
+            for id_object in ids_object
+        ])]
+
+    @staticmethod
+    def _batch_result(result, expected_status):
+        """
+        Translate a Composite Batch subrequest result into a single request result.
+        """
+        status_code = result["statusCode"]
+        if status_code != expected_status:
+            message = result["result"]
+            if not isinstance(message, str):
+                message = json.dumps(message)
+            return {"success": False, "message": message, "status_code": status_code}
+        else:
+            return {"success": True, "status_code": status_code}
@@ -0,0 +1,157 @@
+"""
+Tests for the SalesForce token cache, the token renewal and the batch requests.
+"""
+import json
+import time
+import unittest
+
+import mock
+from xblock.field_data import DictFieldData
+from xblock.fields import ScopeIds
+from xblock.test.tools import TestRuntime
+
+from crm_integration_xblock import crm_integration_xblock as crm
+from crm_integration_xblock import salesforce_tasks
+from crm_integration_xblock.crm_integration_xblock import CrmIntegration
+from crm_integration_xblock.salesforce_tasks import SalesForce
+
+CUSTOM_QUERY = {"initial": {"object_sf": "custom_query"},
+                "custom_query": "SELECT Id FROM Proyectos__c WHERE project_id__c='{user_id}'"}
+
+
+def make_response(status_code, json_data=None):
+    """Mock of a requests response"""
+    response = mock.Mock(status_code=status_code, text=json.dumps(json_data), url="https://sf.test")
+    response.json.return_value = json_data
+    response.raw.retries = None
+    return response
+
+
+def token_response(issued_at=None):
+    """Response of the SalesForce token endpoint, issued_at is in milliseconds"""
+    if issued_at is None:
+        issued_at = time.time()
+    return make_response(200, {"access_token": "token",
+                               "instance_url": "https://instance.test",
+                               "issued_at": str(int(issued_at * 1000))})
+
+
+@mock.patch("crm_integration_xblock.salesforce_tasks.emit", mock.Mock())
+@mock.patch("crm_integration_xblock.crm_integration_xblock.emit", mock.Mock())
+class TestTokenCache(unittest.TestCase):
+    """
+    Tests for the reuse of the SalesForce access tokens across requests.
+    """
+
+    def setUp(self):
+        crm._TOKEN_CACHE.clear()  # pylint: disable=protected-access
+        crm._BACKEND_POOL.__dict__.clear()  # pylint: disable=protected-access
+        runtime = TestRuntime(services={"field-data": DictFieldData({})})
+        self.block = CrmIntegration(runtime, scope_ids=ScopeIds("user", "crm-integration", "def", "usage"))
+        self.block.xmodule_runtime = mock.Mock(spec=[])
+        self.block.backend_name = "varkey"
+        self.block.url = "https://login.test/services/oauth2/token"
+        self.block.client_id = "client"
+        self.block.client_secret = "secret"
+        self.block.username = "user@test"
+        self.block.password = "password"
+        self.block.security_token = "security"
+
+        patcher = mock.patch.object(CrmIntegration, "get_anonymous_id_comp_crm", return_value="anonymous")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(crm.TOKEN_SESSION, "post")
+        self.token_post = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(crm.SESSION, "request")
+        self.sf_request = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_query(self):
+        """Send a custom query through the block"""
+        return self.block._run_backend(dict(CUSTOM_QUERY), "validate")  # pylint: disable=protected-access
+
+    def test_cached_token_is_reused(self):
+        self.token_post.return_value = token_response()
+        self.sf_request.return_value = make_response(200, {"totalSize": 0})
+
+        self.assertEqual(self.run_query()["status_code"], 200)
+        self.assertEqual(self.run_query()["status_code"], 200)
+
+        self.assertEqual(self.token_post.call_count, 1)
+        self.assertEqual(self.sf_request.call_count, 2)
+
+    def test_token_of_other_secrets_is_not_reused(self):
+        self.token_post.return_value = token_response()
+        self.sf_request.return_value = make_response(200, {"totalSize": 0})
+
+        self.run_query()
+        self.block.password = "other password"
+        self.run_query()
+
+        self.assertEqual(self.token_post.call_count, 2)
+
+    def test_expiration_uses_issued_at_in_milliseconds(self):
+        issued_at = time.time() - 100
+        entry = crm._cache_token("key", token_response(issued_at).json())  # pylint: disable=protected-access
+        self.assertAlmostEqual(entry[2], issued_at + crm.TOKEN_DEFAULT_LIFETIME, delta=1)
+
+    def test_expired_token_is_renewed(self):
+        # Issued long enough ago to be within the expiration margin
+        self.token_post.return_value = token_response(time.time() - crm.TOKEN_DEFAULT_LIFETIME + 30)
+        self.sf_request.return_value = make_response(200, {"totalSize": 0})
+
+        self.run_query()
+        self.run_query()
+
+        self.assertEqual(self.token_post.call_count, 2)
+
+    def test_rejected_cached_token_is_renewed_once(self):
+        self.token_post.return_value = token_response()
+        self.sf_request.return_value = make_response(200, {"totalSize": 0})
+        self.run_query()
+
+        self.sf_request.side_effect = [
+            make_response(401, [{"errorCode": "INVALID_SESSION_ID"}]),
+            make_response(200, {"totalSize": 1}),
+        ]
+        result = self.run_query()
+
+        self.assertEqual(result, {"message": {"totalSize": 1}, "status_code": 200})
+        self.assertEqual(self.token_post.call_count, 2)
+        self.assertEqual(self.sf_request.call_count, 3)
+
+    def test_rejected_fresh_token_is_reported(self):
+        self.token_post.return_value = token_response()
+        self.sf_request.return_value = make_response(401, [{"errorCode": "INVALID_SESSION_ID"}])
+
+        result = self.run_query()
+
+        self.assertEqual(result["status_code"], 401)
+        self.assertFalse(result["success"])
+        self.assertEqual(self.token_post.call_count, 1)
+        self.assertEqual(self.sf_request.call_count, 1)
+
+
+@mock.patch("crm_integration_xblock.salesforce_tasks.emit", mock.Mock())
+class TestBatch(unittest.TestCase):
+    """
+    Tests for the Composite Batch requests.
+    """
+
+    def test_batch_is_split(self):
+        def batch_response(method, url, **kwargs):  # pylint: disable=unused-argument
+            batch_requests = json.loads(kwargs["data"])["batchRequests"]
+            return make_response(200, {"hasErrors": False,
+                                       "results": [{"statusCode": 204, "result": None}] * len(batch_requests)})
+
+        session = mock.Mock()
+        session.request.side_effect = batch_response
+        ids = ["id{}".format(i) for i in range(30)]
+
+        results = SalesForce("token", "https://instance.test", session).delete_many("Accion__c", ids)
+
+        sizes = [len(json.loads(call[1]["data"])["batchRequests"]) for call in session.request.call_args_list]
+        self.assertEqual(sizes, [salesforce_tasks.BATCH_LIMIT, 5])
+        self.assertEqual(len(results), 30)
+        self.assertTrue(all(result["success"] for result in results))
@@ -2,6 +2,8 @@
 Wrapper module fo the tracker.emit functions
 """
 import logging
+import queue
+import threading
 from django.conf import settings
 
 try:
@@ -17,16 +19,59 @@ except ImportError:
     LOG.warning(u"Could not load the eventtracking module")
 
 
+# Events waiting to be sent by the background thread, so the requests don't wait for the tracker
+EMIT_QUEUE_MAXSIZE = 10000
+_EMIT_QUEUE = queue.Queue(maxsize=EMIT_QUEUE_MAXSIZE)
+_EMIT_WORKER = None
+_EMIT_WORKER_LOCK = threading.Lock()
+# Events discarded because the queue was full
+EMIT_STATS = {"dropped": 0}
+
+
+def _emit_worker():
+    """Send the queued events to the tracker"""
+    while True:
+        event, data, context = _EMIT_QUEUE.get()
+        try:
+            # The worker thread has no request, restore the context resolved when the event happened
+            with tracker.get_tracker().context("crm_integration_xblock", context):
+                tracker.emit(
+                    event,
+                    data
+                )
+        except Exception:  # pylint: disable=broad-except
+            LOG.exception(u"Could not emit the event %s", event)
+
+
+def _start_emit_worker():
+    """Start the background thread, also in processes forked after it was started"""
+    global _EMIT_WORKER  # pylint: disable=global-statement
+    with _EMIT_WORKER_LOCK:
+        if _EMIT_WORKER is None or not _EMIT_WORKER.is_alive():
+            _EMIT_WORKER = threading.Thread(target=_emit_worker, name="crm_integration_xblock.emit")
+            _EMIT_WORKER.daemon = True
+            _EMIT_WORKER.start()
+
+
 def emit(event, priority=20, data=None):
-    """Wrapper for the openedx tracker function"""
+    """
+    Wrapper for the openedx tracker function.
+    data can be a callable, which is only called when the event is tracked.
+    Use it for data that is expensive to build, like a serialized response.
+    """
     level = 30
     if configuration_helpers:
         level = configuration_helpers.get_value("CRM_INTEGRATION_TRACKING_LEVEL", level)  # pylint: disable=no-member
     if priority > getattr(settings, "CRM_INTEGRATION_TRACKING_LEVEL", level):
-        tracker.emit(
-            event,
-            data
-        )
+        if callable(data):
+            data = data()
+        if _EMIT_WORKER is None or not _EMIT_WORKER.is_alive():
+            _start_emit_worker()
+        try:
+            _EMIT_QUEUE.put_nowait((event, data, tracker.get_tracker().resolve_context()))
+        except queue.Full:
+            EMIT_STATS["dropped"] += 1
+            LOG.warning(u"Tracking queue full, %s events dropped", EMIT_STATS["dropped"])
 
 
 def serialize_response(response):
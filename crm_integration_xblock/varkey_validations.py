@@ -3,8 +3,6 @@ SalesForce Varkey Integration Xblock.
 
 This only works for Varkey purpose
 """
-import json
-
 from .salesforce_tasks import SalesForce
 from .tracking import emit
 
@@ -25,19 +23,29 @@ class SalesForceVarkey(SalesForce):
         that's why we have to validate wich type of form are receiving.
     """
 
-    def __init__(self, token, instance_url, username, method, initial):  # pylint: disable=too-many-arguments
+    def __init__(self, token, instance_url, username, method, initial, session=None):  # pylint: disable=too-many-arguments
         """
         Each time a form is displayed we show an info automatically. For show
         this info we set the method "receive" from the jsinput, if the user
         click submit we set the method "send" in the jsinput.
         """
-        super(SalesForceVarkey, self).__init__(token, instance_url)
+        super(SalesForceVarkey, self).__init__(token, instance_url, session)
         self.token = token
         self.instance_url = instance_url
         self.username = username
         self.method = method
         self.initial = initial
 
+    def update_context(self, token, username, method, initial):  # pylint: disable=arguments-differ
+        """
+        Rebind a pooled instance to the token and the form of the current request.
+        """
+        super(SalesForceVarkey, self).update_context(token)
+        self.token = token
+        self.username = username
+        self.method = method
+        self.initial = initial
+
     def validate(self, data):  # pylint: disable=too-many-return-statements
         """
         Mandatory method. For Varkey case handles the way
@@ -70,19 +78,17 @@ class SalesForceVarkey(SalesForce):
             user_id=self.username,
         )
         response = self.query(parsed_query)
-        salesforce_response = json.loads(response.text)
+        salesforce_response = response.json()
         return {"message": salesforce_response, "status_code": response.status_code}
 
     def _delete_data(self, data):
         """
-        Delete records one by one.
+        Delete the records in batches.
         """
         salesforce_object = data["initial"]["object_sf"]
         records_to_delete = data["id"]
-        results = []
-        for salesforce_id in records_to_delete:
-            delete = self.delete(salesforce_object, salesforce_id)
-            results.append({salesforce_id:delete})
+        deleted = self.delete_many(salesforce_object, records_to_delete)
+        results = [{salesforce_id:delete} for salesforce_id, delete in zip(records_to_delete, deleted)]
 
         return {"response":results}
 
@@ -94,7 +100,7 @@ class SalesForceVarkey(SalesForce):
         if self._send_or_receive(self.method):
             cue_id = data["answers"]["CUE__c"]
             response = self.get("Account/CUE__c", data, id_object=cue_id)
-            data_response = json.loads(response.text)
+            data_response = response.json()
 
             if response.status_code == 200:
                 school_id = data_response["Id"]
@@ -120,7 +126,7 @@ class SalesForceVarkey(SalesForce):
         """
         if self._send_or_receive(self.method):
             response = self.query("SELECT Escuela__r.Name, Escuela__r.CUE__c, Escuela__r.Id FROM Historial_escuela__c WHERE project_id__c='{}'".format(self.username))  # pylint: disable=line-too-long
-            salesforce_response = json.loads(response.text)
+            salesforce_response = response.json()
 
             if response.status_code == 200:
                 school_id = salesforce_response["records"][0]["Escuela__r"]["Id"]
@@ -145,17 +151,18 @@ class SalesForceVarkey(SalesForce):
 
         if method == "POST":
             bulk = self.bulk(salesforce_object, answers)
-            return {"message":json.loads(bulk.text)}
+            return {"message":bulk.json()}
 
         if method == "PATCH":
-            results = []
+            records = []
             for answer in answers:
                 salesforce_id = answer["salesforce_id"]
                 del answer["salesforce_id"]  # delete unnecessary fields
-                response = self.update(salesforce_object, answer, salesforce_id)
-                # Since the request is one by one, we storage each response
-                # to return and give complete information to the consumer client.
-                results.append({salesforce_id:response})
+                records.append((salesforce_id, answer))
+            # The records are updated in batches, but we still return each response
+            # to give complete information to the consumer client.
+            updated = self.update_many(salesforce_object, records)
+            results = [{salesforce_id:response} for (salesforce_id, _), response in zip(records, updated)]
 
             return {"response": results}
 
@@ -181,14 +188,14 @@ class SalesForceVarkey(SalesForce):
         # exists fields that does not belong to the object.
         data["answers"].pop("CUE__c", None)
 
-        response = self.query("SELECT Escuela__r.CUE__c FROM Historial_escuela__c WHERE project_id__c='{}'".format(self.username))  # pylint: disable=line-too-long
-        salesforce_response = json.loads(response.text)
-
         # Since in Varkey there are two objects to create or update
         # we need to check which of them we are consulting.
+        # Only one query is sent, the response of the other one would be discarded.
         if salesforce_object == "Proyectos__c":
             response = self.query("SELECT Id FROM {} WHERE project_id__c='{}'".format(salesforce_object, self.username))  # pylint: disable=line-too-long
-            salesforce_response = json.loads(response.text)
+        else:
+            response = self.query("SELECT Escuela__r.CUE__c FROM Historial_escuela__c WHERE project_id__c='{}'".format(self.username))  # pylint: disable=line-too-long
+        salesforce_response = response.json()
 
         total_objects = salesforce_response["totalSize"]
 
@@ -30,6 +30,7 @@ setup(
     packages=[
         'crm_integration_xblock',
     ],
+    python_requires='>=3.9',
     install_requires=[
         'XBlock',
     ],